@@ -1,11 +1,63 @@
-from typing import Optional, Sequence
+from typing import Optional, Sequence, Union
 import numpy as np
 import torch
+from scipy.signal import lfilter
 
 from cs285.networks.policies import MLPPolicyPG
 from cs285.networks.critics import ValueCritic
 from cs285.infrastructure import pytorch_util as ptu
 from torch import nn
+from torch.nn import functional as F
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; without it the TorchScript recurrence is used on every device
+    njit = None
+
+
+@torch.jit.script
+def _gae(
+    rewards: torch.Tensor,
+    next_values: torch.Tensor,
+    values: torch.Tensor,
+    not_done: torch.Tensor,
+    gamma: float,
+    lam: float,
+    advantages: torch.Tensor,
+) -> torch.Tensor:
+    """Generalized advantage estimation over a flat batch of concatenated trajectories, written into `advantages`.
+
+    Scripted so the backward recurrence runs as one TorchScript graph instead of one Python-dispatched op per step.
+    """
+    deltas = rewards + gamma * next_values * not_done - values
+    acc = torch.zeros((), dtype=deltas.dtype, device=deltas.device)
+    for t in range(deltas.shape[0] - 1, -1, -1):
+        acc = deltas[t] + gamma * lam * not_done[t] * acc
+        advantages[t] = acc
+    return advantages
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _gae_numba(rewards, next_values, values, not_done, gamma, lam, advantages):
+        """Same recurrence as `_gae`, compiled to a tight native loop over float32 NumPy arrays for CPU runs."""
+        acc = 0.0
+        for t in range(rewards.shape[0] - 1, -1, -1):
+            delta = rewards[t] + gamma * next_values[t] * not_done[t] - values[t]
+            acc = delta + gamma * lam * not_done[t] * acc
+            advantages[t] = acc
+        return advantages
+
+else:
+    _gae_numba = None
+
+
+def _flatten(batch: Union[Sequence[np.ndarray], np.ndarray], is_flat: bool) -> np.ndarray:
+    """Concatenates per-trajectory arrays along time; a batch that is already flat is passed through without a copy."""
+    if is_flat:
+        return batch
+    return np.concatenate(batch)
 
 
 class PGAgent(nn.Module):
@@ -24,6 +76,8 @@ class PGAgent(nn.Module):
         baseline_gradient_steps: Optional[int],
         gae_lambda: Optional[float],
         normalize_advantages: bool,
+        baseline_batch_size: Optional[int] = None,
+        normalize_advantages_per_traj: bool = False,
     ):
         super().__init__()
 
@@ -38,6 +92,7 @@ class PGAgent(nn.Module):
                 ob_dim, n_layers, layer_size, baseline_learning_rate
             )
             self.baseline_gradient_steps = baseline_gradient_steps
+            self.baseline_batch_size = baseline_batch_size
         else:
             self.critic = None
 
@@ -46,34 +101,57 @@ class PGAgent(nn.Module):
         self.use_reward_to_go = use_reward_to_go
         self.gae_lambda = gae_lambda
         self.normalize_advantages = normalize_advantages
+        self.normalize_advantages_per_traj = normalize_advantages_per_traj
+
+        # cache of gamma^t for t = 0, 1, ..., grown lazily to the longest trajectory seen
+        self._gamma_pows = np.array([], dtype=np.float32)
+        # the critic/Q-value shape agreement only needs checking once; shapes don't change between updates
+        self._shape_checked = False
+        # reusable output buffer for GAE, grown geometrically so most updates don't allocate
+        self._adv_buf: Optional[torch.Tensor] = None
 
     def update(
         self,
-        obs: Sequence[np.ndarray],
-        actions: Sequence[np.ndarray],
-        rewards: Sequence[np.ndarray],
-        terminals: Sequence[np.ndarray],
+        obs: Union[Sequence[np.ndarray], np.ndarray],
+        actions: Union[Sequence[np.ndarray], np.ndarray],
+        rewards: Union[Sequence[np.ndarray], np.ndarray],
+        terminals: Union[Sequence[np.ndarray], np.ndarray],
     ) -> dict:
         """The train step for PG involves updating its actor using the given observations/actions and the calculated
         qvals/advantages that come from the seen rewards.
 
         Each input is a list of NumPy arrays, where each array corresponds to a single trajectory. The batch size is the
         total number of samples across all trajectories (i.e. the sum of the lengths of all the arrays).
+
+        Alternatively, each input may be a single array that is already flat across trajectories, as produced by
+        `utils.sample_trajectories_flat`; trajectory boundaries are then recovered from `terminals`.
         """
+        # a 1D rewards array can only be a flat batch; a 2D one is equal-length trajectories stacked as rows
+        is_flat = isinstance(rewards, np.ndarray) and rewards.ndim == 1
+        if is_flat:
+            # split the flat rewards into per-trajectory views (no copy) for the Monte Carlo estimate below
+            rewards_per_traj = np.split(rewards, np.flatnonzero(terminals)[:-1] + 1)
+        else:
+            rewards_per_traj = rewards
 
         # step 1: calculate Q values of each (s_t, a_t) point, using rewards (r_0, ..., r_t, ..., r_T)
-        q_values: Sequence[np.ndarray] = self._calculate_q_vals(rewards)
+        q_values: Sequence[np.ndarray] = self._calculate_q_vals(rewards_per_traj)
 
         # TODO: flatten the lists of arrays into single arrays, so that the rest of the code can be written in a vectorized
         # way. obs, actions, rewards, terminals, and q_values should all be arrays with a leading dimension of `batch_size`
-        # beyond this point.
-        obs=np.array([item for sublist in obs for item in sublist])
-        actions=np.array([item for sublist in actions for item in sublist])
-        rewards=np.array([item for sublist in rewards for item in sublist])
-        terminals=np.array([item for sublist in terminals for item in sublist])
-        q_values=np.array([item for sublist in q_values for item in sublist])
+        # beyond this point. obs, actions and q_values are moved to the device once here and stay there as tensors.
+        # Everything is kept float32 (the policy's dtype) so nothing moved to the device is silently float64; discrete
+        # actions are indices and go over as int64 instead.
+        obs = ptu.from_numpy(_flatten(obs, is_flat).astype(np.float32, copy=False))
+        if self.actor.discrete:
+            actions = torch.from_numpy(_flatten(actions, is_flat).astype(np.int64, copy=False)).to(ptu.device)
+        else:
+            actions = ptu.from_numpy(_flatten(actions, is_flat).astype(np.float32, copy=False))
+        rewards = _flatten(rewards, is_flat).astype(np.float32, copy=False)
+        terminals = _flatten(terminals, is_flat).astype(np.float32, copy=False)
+        q_values = ptu.from_numpy(np.concatenate(q_values).astype(np.float32, copy=False))
         # step 2: calculate advantages from Q values
-        advantages: np.ndarray = self._estimate_advantage(
+        advantages: torch.Tensor = self._estimate_advantage(
             obs, rewards, q_values, terminals
         )
 
@@ -84,114 +162,136 @@ class PGAgent(nn.Module):
         # step 4: if needed, use all datapoints (s_t, a_t, q_t) to update the PG critic/baseline
         if self.critic is not None:
             # TODO: perform `self.baseline_gradient_steps` updates to the critic/baseline network
+            # obs and q_values are already on the device, so each step either reuses them directly or indexes a
+            # random minibatch out of them without another host->device copy
+            batch_size = obs.shape[0]
             for i in range(self.baseline_gradient_steps):
-                critic_info: dict = self.critic.update(obs, q_values)
+                if self.baseline_batch_size is not None and self.baseline_batch_size < batch_size:
+                    idx = torch.randint(0, batch_size, (self.baseline_batch_size,), device=obs.device)
+                    critic_info: dict = self.critic.update(obs[idx], q_values[idx])
+                else:
+                    critic_info: dict = self.critic.update(obs, q_values)
             info.update(critic_info)
 
         return info
 
     def _calculate_q_vals(self, rewards: Sequence[np.ndarray]) -> Sequence[np.ndarray]:
         """Monte Carlo estimation of the Q function."""
-        q_values = []
-
         if not self.use_reward_to_go:
             # Case 1: Use the total discounted return from the start of the trajectory for each point
-            for reward in rewards:
-                total_discounted_return = self._discounted_return(reward)
-                # Extend the q_values list with repeated total discounted return for the length of the trajectory
-                q_values.append([total_discounted_return] * len(reward))
+            # the helper returns a float32 array holding the trajectory's total discounted return at every entry
+            q_values = [self._discounted_return(reward) for reward in rewards]
         else:
             # Case 2: Use the discounted reward to go for each point in the trajectory
-            for reward in rewards:
-                q_values.append(self._discounted_reward_to_go(reward))
+            # q_t = r_t + gamma * q_{t+1} is a first-order IIR filter run backwards in time.
+            # filter every trajectory in one call by packing them into a zero-padded matrix; the padding sits at the
+            # end of each row, so after time reversal it is filtered first and contributes nothing
+            lens = [len(reward) for reward in rewards]
+            padded = np.zeros((len(rewards), max(lens)), dtype=np.float32)
+            for row, reward in zip(padded, rewards):
+                row[:len(reward)] = reward
+            rewards_to_go = lfilter([1.0], [1.0, -self.gamma], padded[:, ::-1], axis=1)[:, ::-1]
+            q_values = [row[:n].astype(np.float32, copy=False) for row, n in zip(rewards_to_go, lens)]
 
         return q_values
 
     def _estimate_advantage(
         self,
-            obs: np.ndarray,
+            obs: torch.Tensor,
             rewards: np.ndarray,
-            q_values: np.ndarray,
+            q_values: torch.Tensor,
             terminals: np.ndarray,
-    ) -> np.ndarray:
+    ) -> torch.Tensor:
         """Computes advantages by (possibly) subtracting a value baseline from the estimated Q-values.
 
-        Operates on flat 1D NumPy arrays.
+        Operates on flat 1D arrays; obs and q_values are tensors on `ptu.device`, and so are the returned advantages.
+        With GAE (and no normalization) the result is a view into a buffer owned by the agent, so it is only valid until
+        the next call; clone it if it needs to be kept.
         """
-
         if self.critic is None:
             # TODO: if no baseline, then what are the advantages?
-            advantages = q_values.copy()
+            advantages = q_values
 
         else: # use baseline
             # TODO: run the critic and use it as a baseline
-            values = self.critic(ptu.from_numpy(obs)).squeeze()
-            assert values.shape == q_values.shape
+            with torch.no_grad():
+                values = self.critic(obs).squeeze(-1)
+            if not self._shape_checked:
+                assert tuple(values.shape) == tuple(q_values.shape)
+                self._shape_checked = True
 
             if self.gae_lambda is None:
                 # TODO: if using a baseline, but not GAE, what are the advantages?
-                    advantages = q_values.copy()-ptu.to_numpy(values)
                 # advantages = {reawrd to go}-value function_pi(s_it)
+                advantages = q_values - values
 
             else:
                 # TODO: implement GAE
-                batch_size = obs.shape[0]
-                values_gae = values.detach().cpu().numpy()
-                # HINT: append a dummy T+1 value for simpler recursive calculation
-                values_gae = np.append(values_gae, [0])
-                advantages = np.zeros(batch_size + 1)
-                delta_T=0
-                for i in reversed(range(batch_size)):
-                    # TODO: recursively compute advantage estimates starting from timestep T.
-                    # HINT: use terminals to handle edge cases. terminals[i] is 1 if the state is the last in its
-                    # trajectory, and 0 otherwise.
-                    if terminals[i]==1: # edge
-                        delta_T=rewards[i]-values[i]
-                        advantages[i]=delta_T
-                    else:
-                        delta_T = rewards[i] + self.gamma*values[i+1] - values[i]
-                        advantages[i]=delta_T+self.gamma*self.gae_lambda*advantages[i+1]
-
-
-                # remove dummy advantage
-                advantages = advantages[:-1]
+                rewards_t = torch.as_tensor(rewards, device=values.device, dtype=values.dtype)
+                # terminals[i] is 1 if the state is the last in its trajectory, so V(s_{t+1}) is masked out there;
+                # the dummy T+1 value appended here is only ever read through that mask
+                not_done_t = 1 - torch.as_tensor(terminals, device=values.device, dtype=values.dtype)
+                next_values = F.pad(values, (0, 1))[1:]
+
+                batch_size = values.shape[0]
+                if (
+                    self._adv_buf is None
+                    or self._adv_buf.numel() < batch_size
+                    or self._adv_buf.device != values.device
+                    or self._adv_buf.dtype != values.dtype
+                ):
+                    self._adv_buf = values.new_empty(2 * batch_size)
+                advantages = self._adv_buf[:batch_size]
+
+                # recursively compute advantage estimates starting from timestep T, entirely on-device
+                if _gae_numba is not None and values.device.type == "cpu":
+                    # CPU tensors share memory with NumPy, so handing them to numba is free
+                    _gae_numba(
+                        rewards_t.numpy(), next_values.numpy(), values.numpy(), not_done_t.numpy(),
+                        float(self.gamma), float(self.gae_lambda), advantages.numpy(),
+                    )
+                else:
+                    _gae(
+                        rewards_t, next_values, values, not_done_t, float(self.gamma), float(self.gae_lambda),
+                        advantages,
+                    )
 
         # TODO: normalize the advantages to have a mean of zero and a standard deviation of one within the batch
         if self.normalize_advantages:
+            if self.normalize_advantages_per_traj:
+                advantages = self._normalize_per_trajectory(advantages, terminals)
+            else:
+                advantages = (advantages - advantages.mean()) / (advantages.std(unbiased=False) + 1e-8)
+        return advantages
 
-            ind=1
-            adv_ind=0
-            for terminal in terminals:
-                if terminal == 1:
-                    advantages[adv_ind:adv_ind+ind]/=ind
-                    adv_ind+=ind
-                    ind=1
-                else:
-                    ind+=1
-        return np.array(advantages)
+    def _normalize_per_trajectory(self, advantages: torch.Tensor, terminals: np.ndarray) -> torch.Tensor:
+        """Standardizes advantages to zero mean and unit standard deviation separately within each trajectory."""
+        # trajectory boundaries are cheap to find on the host; the per-segment statistics are reduced on-device
+        ends = np.flatnonzero(terminals == 1) + 1
+        starts = np.concatenate([[0], ends[:-1]])
+        counts = ends - starts
+        seg_ids = torch.as_tensor(np.repeat(np.arange(len(counts)), counts), device=advantages.device)
+        counts = torch.as_tensor(counts, device=advantages.device, dtype=advantages.dtype)
+
+        means = advantages.new_zeros(len(counts)).index_add_(0, seg_ids, advantages) / counts
+        centered = advantages - means[seg_ids]
+        stds = (advantages.new_zeros(len(counts)).index_add_(0, seg_ids, centered ** 2) / counts).sqrt()
+        return centered / (stds[seg_ids] + 1e-8)
 
-    def _discounted_return(self, rewards: Sequence[float]) -> Sequence[float]:
+    def _discounted_return(self, rewards: Sequence[float]) -> np.ndarray:
         """
         Helper function which takes a list of rewards {r_0, r_1, ..., r_t', ... r_T} and returns
-        a list where each index t contains sum_{t'=0}^T gamma^t' r_{t'}
+        a float32 array where each index t contains sum_{t'=0}^T gamma^t' r_{t'}
 
-        Note that all entries of the output list should be the exact same because each sum is from 0 to T (and doesn't
-        involve t)!
+        Note that all entries of the output array are the exact same total discounted return, because each sum is from
+        0 to T (and doesn't involve t)!
         """
-        discount_rewards=list()
-        for i in range(len(rewards)):
-            discount_rewards.append(self.gamma ** i * rewards[i])
-        _sum = sum(discount_rewards)
-        new_rewards = list()
-        for i in range(len(rewards)):
-            new_rewards.append(_sum)
-        return new_rewards
-
-    def _discounted_reward_to_go(self, rewards: Sequence[float]) -> Sequence[float]:
-        n = len(rewards)
-        discount_rewards_to_go = [0] * n
-        cumulative = 0
-        for i in reversed(range(n)):
-            cumulative = rewards[i] + self.gamma * cumulative  # 현재 보상 + (할인된 미래 보상)
-            discount_rewards_to_go[i] = cumulative
-        return discount_rewards_to_go
+        rewards = np.asarray(rewards, dtype=np.float32)
+        total = float(self._get_gamma_pows(len(rewards)) @ rewards)
+        return np.full(len(rewards), total, dtype=np.float32)
+
+    def _get_gamma_pows(self, n: int) -> np.ndarray:
+        """Returns [gamma^0, gamma^1, ..., gamma^(n-1)] as a view into a cached array."""
+        if n > len(self._gamma_pows):
+            self._gamma_pows = np.power(self.gamma, np.arange(n, dtype=np.float32)).astype(np.float32)
+        return self._gamma_pows[:n]
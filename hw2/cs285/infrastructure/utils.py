@@ -5,18 +5,41 @@ from cs285.networks.policies import MLPPolicy
 import gym
 import cv2
 from cs285.infrastructure import pytorch_util as ptu
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
 
 ############################################
 ############################################
 
 
+def _empty_rollout(env: gym.Env, length: int) -> Dict[str, np.ndarray]:
+    """Preallocate float32 arrays with room for `length` steps of every recorded per-step quantity."""
+    ob_shape = env.observation_space.shape
+    ac_shape = env.action_space.shape
+    return {
+        "observation": np.empty((length, *ob_shape), dtype=np.float32),
+        "reward": np.empty(length, dtype=np.float32),
+        "action": np.empty((length, *ac_shape), dtype=np.float32),
+        "next_observation": np.empty((length, *ob_shape), dtype=np.float32),
+        "terminal": np.empty(length, dtype=np.float32),
+    }
+
+
 def sample_trajectory(
-    env: gym.Env, policy: MLPPolicy, max_length: int, render: bool = False
+    env: gym.Env,
+    policy: MLPPolicy,
+    max_length: int,
+    render: bool = False,
+    out: Optional[Dict[str, np.ndarray]] = None,
 ) -> Dict[str, np.ndarray]:
-    """Sample a rollout in the environment from a policy."""
+    """Sample a rollout in the environment from a policy.
+
+    Each step is written into `out` (arrays with room for at least `max_length` steps, as from `_empty_rollout`), or into
+    freshly allocated arrays if it is not given; the returned per-step arrays are views trimmed to the rollout's length.
+    """
+    if out is None:
+        out = _empty_rollout(env, max_length)
     ob = env.reset()
-    obs, acs, rewards, next_obs, terminals, image_obs = [], [], [], [], [], []
+    image_obs = []
     steps = 0
     import time
     time.sleep(1)
@@ -47,11 +70,12 @@ def sample_trajectory(
         elif steps>=max_length:
             rollout_done: bool = True
         # record result of taking that action
-        obs.append(ob)
-        acs.append(ac)
-        rewards.append(rew)
-        next_obs.append(next_ob)
-        terminals.append(rollout_done)
+        t = steps - 1
+        out["observation"][t] = ob
+        out["action"][t] = ac
+        out["reward"][t] = rew
+        out["next_observation"][t] = next_ob
+        out["terminal"][t] = bool(rollout_done)
 
         ob = next_ob  # jump to next timestep
 
@@ -59,14 +83,9 @@ def sample_trajectory(
         if rollout_done:
             break
 
-    return {
-        "observation": np.array(obs, dtype=np.float32),
-        "image_obs": np.array(image_obs, dtype=np.uint8),
-        "reward": np.array(rewards, dtype=np.float32),
-        "action": np.array(acs, dtype=np.float32),
-        "next_observation": np.array(next_obs, dtype=np.float32),
-        "terminal": np.array(terminals, dtype=np.float32),
-    }
+    traj = {k: v[:steps] for k, v in out.items()}
+    traj["image_obs"] = np.array(image_obs, dtype=np.uint8)
+    return traj
 
 
 def sample_trajectories(
@@ -89,6 +108,33 @@ def sample_trajectories(
     return trajs, timesteps_this_batch
 
 
+def sample_trajectories_flat(
+    env: gym.Env,
+    policy: MLPPolicy,
+    min_timesteps_per_batch: int,
+    max_length: int,
+) -> Tuple[List[Dict[str, np.ndarray]], Dict[str, np.ndarray], int]:
+    """Collect rollouts like `sample_trajectories`, but write every step straight into one preallocated flat batch.
+
+    Returns the trajectories (whose arrays are views into the batch), the batch itself trimmed to the number of steps
+    collected, and that number of steps. The batch can be handed to `PGAgent.update` as-is, with no flattening copy.
+    """
+    # a rollout is only started while fewer than min_timesteps_per_batch steps have been collected, so the batch can
+    # overshoot by at most one trajectory and every rollout has room for max_length steps
+    batch = _empty_rollout(env, min_timesteps_per_batch + max_length)
+
+    trajs = []
+    timesteps_this_batch = 0
+    while timesteps_this_batch < min_timesteps_per_batch:
+        out = {k: v[timesteps_this_batch:] for k, v in batch.items()}
+        traj = sample_trajectory(env, policy, max_length, out=out)
+        trajs.append(traj)
+        timesteps_this_batch += get_traj_length(traj)
+
+    batch = {k: v[:timesteps_this_batch] for k, v in batch.items()}
+    return trajs, batch, timesteps_this_batch
+
+
 def sample_n_trajectories(
     env: gym.Env, policy: MLPPolicy, ntraj: int, max_length: int, render: bool = False
 ):
@@ -1,4 +1,5 @@
 import itertools
+from typing import Union
 from torch import nn
 from torch.nn import functional as F
 from torch import optim
@@ -39,9 +40,11 @@ class ValueCritic(nn.Module):
         return self.network(obs)
         
 
-    def update(self, obs: np.ndarray, q_values: np.ndarray) -> dict:
-        obs = ptu.from_numpy(obs)
-        q_values = ptu.from_numpy(q_values)
+    def update(self, obs: Union[np.ndarray, torch.Tensor], q_values: Union[np.ndarray, torch.Tensor]) -> dict:
+        if isinstance(obs, np.ndarray):
+            obs = ptu.from_numpy(obs)
+        if isinstance(q_values, np.ndarray):
+            q_values = ptu.from_numpy(q_values)
         self.optimizer.zero_grad()
         # TODO: update the critic using the observations and q_values
         loss = F.mse_loss(self.forward(obs),q_values)
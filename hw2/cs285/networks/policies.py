@@ -1,4 +1,5 @@
 import itertools
+from typing import Union
 from torch import nn
 from torch.nn import functional as F
 from torch import optim
@@ -105,21 +106,40 @@ class MLPPolicyPG(MLPPolicy):
 
     def update(
             self,
-            obs: np.ndarray,
-            actions: np.ndarray,
-            advantages: np.ndarray,
+            obs: Union[np.ndarray, torch.Tensor],
+            actions: Union[np.ndarray, torch.Tensor],
+            advantages: Union[np.ndarray, torch.Tensor],
     ) -> dict:
-        """Implements the policy gradient actor update."""
-        obs = ptu.from_numpy(obs)
-        actions = ptu.from_numpy(actions)
-        advantages = ptu.from_numpy(advantages)
+        """Implements the policy gradient actor update. Inputs may be NumPy arrays or tensors already on the device."""
+        if isinstance(obs, np.ndarray):
+            obs = ptu.from_numpy(obs)
+        if isinstance(actions, np.ndarray):
+            actions = ptu.from_numpy(actions)
+        if isinstance(advantages, np.ndarray):
+            advantages = ptu.from_numpy(advantages)
 
         # TODO: implement the policy gradient actor update.
         #
         self.train()
         self.optimizer.zero_grad()
 
+        loss = self.loss(obs, actions, advantages)
 
+        loss.backward()
+        self.optimizer.step()
+
+
+        return {
+            "Actor Loss": ptu.to_numpy(loss),
+        }
+
+    def loss(
+            self,
+            obs: torch.Tensor,
+            actions: torch.Tensor,
+            advantages: torch.Tensor,
+    ) -> torch.Tensor:
+        """Computes the policy gradient surrogate loss for a batch of observations, actions and advantages."""
         if self.discrete:
             action_prob = self.forward(obs)
             actions = actions.unsqueeze(-1)
@@ -128,14 +148,5 @@ class MLPPolicyPG(MLPPolicy):
         else:
             outputs = self.forward(obs)
             log_probs = outputs.log_prob(actions)  # 로그 확률 계산
-            advantages = advantages
             loss = -(log_probs * advantages).mean()
-
-
-        loss.backward()
-        self.optimizer.step()
-
-
-        return {
-            "Actor Loss": ptu.to_numpy(loss),
-        }
+        return loss
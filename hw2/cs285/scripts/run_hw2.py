@@ -58,8 +58,10 @@ def run_training_loop(args):
         use_baseline=args.use_baseline,
         use_reward_to_go=args.use_reward_to_go,
         normalize_advantages=args.normalize_advantages,
+        normalize_advantages_per_traj=args.normalize_advantages_per_traj,
         baseline_learning_rate=args.baseline_learning_rate,
         baseline_gradient_steps=args.baseline_gradient_steps,
+        baseline_batch_size=args.baseline_batch_size,
         gae_lambda=args.gae_lambda,
     )
 
@@ -70,15 +72,12 @@ def run_training_loop(args):
         print(f"\n********** Iteration {itr} ************")
         # TODO: sample `args.batch_size` transitions using utils.sample_trajectories
         # make sure to use `max_ep_len`
-        trajs, envsteps_this_batch = utils.sample_trajectories(env,agent.actor,args.batch_size,max_ep_len)
+        # the trajectories are written straight into one flat batch, so the update doesn't have to flatten them again
+        trajs, batch, envsteps_this_batch = utils.sample_trajectories_flat(env,agent.actor,args.batch_size,max_ep_len)
         total_envsteps += envsteps_this_batch
 
-        # trajs should be a list of dictionaries of NumPy arrays, where each dictionary corresponds to a trajectory.
-        # this line converts this into a single dictionary of lists of NumPy arrays.
-        trajs_dict = {k: [traj[k] for traj in trajs] for k in trajs[0]}
-
         # TODO: train the agent using the sampled trajectories and the agent's update function
-        train_info: dict = agent.update(obs=trajs_dict['observation'],actions=trajs_dict['action'],rewards=trajs_dict['reward'],terminals=trajs_dict['terminal'])
+        train_info: dict = agent.update(obs=batch['observation'],actions=batch['action'],rewards=batch['reward'],terminals=batch['terminal'])
 
         if itr % args.scalar_log_freq == 0:
             # save eval metrics
@@ -134,8 +133,14 @@ def main():
     parser.add_argument("--use_baseline", action="store_true")
     parser.add_argument("--baseline_learning_rate", "-blr", type=float, default=5e-3)
     parser.add_argument("--baseline_gradient_steps", "-bgs", type=int, default=5)
+    parser.add_argument(
+        "--baseline_batch_size", "-bbs", type=int, default=None
+    )  # minibatch size per baseline gradient step; defaults to the full batch
     parser.add_argument("--gae_lambda", type=float, default=None)
     parser.add_argument("--normalize_advantages", "-na", action="store_true")
+    parser.add_argument(
+        "--normalize_advantages_per_traj", action="store_true"
+    )  # with -na, standardize within each trajectory instead of across the batch
     parser.add_argument(
         "--batch_size", "-b", type=int, default=1000
     )  # steps collected per train iteration